@@ -5,15 +5,36 @@ except ImportError:
     print("Please install click with pip3 install click")
     exit(1)
 
+import atexit
+import functools
 import getpass
+import hashlib
 import json
 import logging
 import os
+import shlex
+import shutil
+import signal
+import string
 import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 from typing import List, Optional
 
-VENV_ACTIVE = False
+try:
+    import urllib3
+
+    # one pool for all outbound HTTPS so repeat lookups reuse the TLS session
+    _HTTP = urllib3.PoolManager(timeout=3.0, retries=urllib3.Retry(2))
+except ImportError:
+    _HTTP = None
+
 PROJECT_NAME = None
 # gunicorn_service_path = "/etc/systemd/system/gunicorn.service"
 # gunicorn_socket_path = "/etc/systemd/system/gunicorn.socket"
@@ -26,9 +47,30 @@ nginx_sites_enabled_path = "/home/aman/templates/nginx-sites-enabled.template"
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+
+
+def _load_template(name: str) -> string.Template:
+    """
+    Loads and validates a template at import time so a broken or missing
+    template fails the run immediately instead of after apt/git/pip have run.
+    """
+    content = Path(__file__).parent.joinpath("templates", name).read_text(encoding="utf-8")
+    # templates use {{NAME}} markers; convert once to string.Template's ${NAME}
+    template = string.Template(content.replace("{{", "${").replace("}}", "}"))
+    if hasattr(template, "is_valid") and not template.is_valid():
+        raise ValueError(f"Template {name} has invalid placeholders")
+    return template
+
+
+GUNICORN_SOCKET_TMPL = _load_template("gunicorn.socket")
+GUNICORN_SERVICE_TMPL = _load_template("gunicorn.service")
+NGINX_CONF_TMPL = _load_template("nginx.conf")
+
 artifacts_dir = Path().home().joinpath(".deployment_artifacts")
 stage_file = artifacts_dir.joinpath("stage.json")
 previous_stages = {}
+stage_lock = threading.Lock()
+_stages_dirty = False
 if not artifacts_dir.exists():
     artifacts_dir.mkdir(parents=True, exist_ok=True)
 
@@ -40,16 +82,30 @@ def load_artifacts(root_path):
 
     artifacts_dir = root_path.joinpath(".deployment_artifacts")
     logger.info(f"Artifacts directory: {artifacts_dir.absolute()}")
+    artifacts_dir.mkdir(parents=True, exist_ok=True)
     stage_file = artifacts_dir.joinpath("stage.json")
-    if not stage_file.exists():
-        stage_file.touch()
-        stage_file.write_text("{}")
 
+    # single read; a missing or corrupt file just means an empty stage cache
     try:
-        with open(stage_file, "r") as f:
-            previous_stages = json.load(f)
+        previous_stages = json.loads(stage_file.read_text(encoding="utf-8") or "{}")
     except Exception:
-        pass
+        previous_stages = {}
+
+
+@dataclass(frozen=True)
+class DeployPaths:
+    """Deploy-wide paths resolved and stringified once instead of per stage."""
+
+    project_dir: Path
+    venv: Path
+    project_dir_str: str
+    venv_str: str
+
+    @classmethod
+    def build(cls, home_dir: Path, project_name: str) -> "DeployPaths":
+        project_dir = home_dir.joinpath(project_name, project_name).resolve()
+        venv = project_dir.parent.joinpath("venv")
+        return cls(project_dir=project_dir, venv=venv, project_dir_str=str(project_dir), venv_str=str(venv))
 
 
 class DeploymentException(Exception):
@@ -60,86 +116,255 @@ class InstallationException(Exception):
     pass
 
 
-def run_command(command: List[str], use_sudo: bool = True, raise_on_error: bool = True):
-    if use_sudo:
-        command = ["sudo"] + command
-    logger.info(f"Running command: {' '.join(command)}")
-    process = subprocess.run(command)
-    if process.returncode != 0 and raise_on_error:
+_sudo_shell = None
+_sudo_shell_lock = threading.Lock()
+# already root (CI/containers): every sudo prefix is pure PAM overhead
+_IS_ROOT = os.geteuid() == 0
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_bin(name: str) -> str:
+    """Resolves a binary through PATH once so each exec is a direct lookup."""
+    return shutil.which(name) or name
+
+
+def _sudo_keepalive(interval: float = 60.0):
+    while True:
+        time.sleep(interval)
+        subprocess.run(["sudo", "-n", "-v"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def warm_sudo_ticket():
+    """
+    Validates sudo once up front, then keeps the timestamp fresh from a daemon
+    thread so no later command can stall on a password prompt mid-deploy.
+    """
+    subprocess.run(["sudo", "-v"], check=True)
+    threading.Thread(target=_sudo_keepalive, daemon=True).start()
+
+
+# per-process marker for the shell's exit-code line; a uuid keeps it from ever
+# colliding with real command output
+_SUDO_SENTINEL = f"__deploy_rc_{uuid.uuid4().hex}__".encode("utf-8")
+
+# sudo's env_reset strips these from the calling environment, so setting them
+# in os.environ never reaches apt — they must be exported inside the root
+# shell itself to keep apt/dpkg/debconf prompt-free
+_SUDO_SHELL_EXPORTS = {
+    "DEBIAN_FRONTEND": "noninteractive",
+    "DEBCONF_NONINTERACTIVE_SEEN": "true",
+    "APT_LISTCHANGES_FRONTEND": "none",
+}
+
+
+def _run_in_sudo_shell(command: List[str], quiet: bool = True, env: Optional[dict] = None):
+    """
+    Runs a command inside one long-lived `sudo bash` process so each sudo
+    command skips the per-call fork/exec and sudoers evaluation.
+    Returns (returncode, captured output).
+    """
+    global _sudo_shell
+    with _sudo_shell_lock:
+        if _sudo_shell is None or _sudo_shell.poll() is not None:
+            # stderr merges into the pipe so quiet/captured output includes
+            # apt/dpkg errors instead of leaking them to the TTY
+            _sudo_shell = subprocess.Popen(
+                ["sudo", "-S", "bash"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                bufsize=0,
+            )
+            exports = "".join(f"export {key}={shlex.quote(value)}\n" for key, value in _SUDO_SHELL_EXPORTS.items())
+            _sudo_shell.stdin.write(exports.encode("utf-8"))
+        if env:
+            # per-command env goes through env(1); the shell's own environment
+            # stays untouched for later commands
+            command = ["env"] + [f"{key}={value}" for key, value in env.items()] + command
+        _sudo_shell.stdin.write(
+            (shlex.join(command) + "\nprintf '%s %d\\n' " + _SUDO_SENTINEL.decode() + " $?\n").encode("utf-8")
+        )
+        _sudo_shell.stdin.flush()
+        # swallow or pass command output through until the sentinel line with
+        # the exit code; find() keeps this safe for output without a trailing
+        # newline or with embedded NUL bytes
+        output = bytearray()
+        while True:
+            line = _sudo_shell.stdout.readline()
+            if not line:
+                return 1, bytes(output)
+            index = line.find(_SUDO_SENTINEL)
+            if index == -1:
+                if quiet:
+                    output += line
+                else:
+                    sys.stdout.buffer.write(line)
+                continue
+            if index > 0:
+                if quiet:
+                    output += line[:index]
+                else:
+                    sys.stdout.buffer.write(line[:index])
+            try:
+                return int(line[index:].split()[1]), bytes(output)
+            except (IndexError, ValueError):
+                return 1, bytes(output)
+
+
+def run_command(
+    command: List[str],
+    use_sudo: bool = True,
+    raise_on_error: bool = True,
+    env: Optional[dict] = None,
+    quiet: bool = True,
+):
+    command = [_resolve_bin(command[0])] + command[1:]
+    logger.info(f"Running command: {('sudo ' if use_sudo and not _IS_ROOT else '') + ' '.join(command)}")
+    output = b""
+    if use_sudo and not _IS_ROOT:
+        returncode, output = _run_in_sudo_shell(command, quiet=quiet, env=env)
+    elif quiet:
+        # drop progress bars/ANSI noise; the tail is surfaced on failure
+        process = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        returncode = process.returncode
+        output = process.stdout or b""
+    else:
+        returncode = subprocess.run(command, env=env).returncode
+    if returncode != 0 and raise_on_error:
+        if output:
+            logger.error(output[-8192:].decode(errors="replace"))
         raise DeploymentException(f"Failed to run command: {command}")
 
 
+def http_get(url: str, timeout: float = 3.0) -> str:
+    if _HTTP is not None:
+        return _HTTP.request("GET", url).data.decode("utf-8")
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read().decode("utf-8")
+
+
+@functools.lru_cache(maxsize=None)
 def get_public_ip() -> Optional[str]:
-    # curl https://ipv4.icanhazip.com/
+    # GET https://ipv4.icanhazip.com/ with a short timeout so a blackholed
+    # network cannot stall the deploy
     try:
-        ip = subprocess.check_output(["curl", "https://ipv4.icanhazip.com/"])
-        ip = ip.decode("utf-8").strip()
-        return ip
+        return http_get("https://ipv4.icanhazip.com/").strip()
     except Exception as e:
         logger.error(e)
         return None
 
 
-def shell_source(script):
-    """Sometime you want to emulate the action of "source" in bash,
-    settings some environment variables. Here is a way to do it."""
-    pipe = subprocess.Popen(". %s; env" % script, stdout=subprocess.PIPE, shell=True)
-    output = pipe.communicate()[0].decode("utf-8")
-    env = dict((line.split("=", 1) for line in output.splitlines()))
-    os.environ.update(env)
+@functools.lru_cache(maxsize=None)
+def _current_user() -> str:
+    return getpass.getuser()
 
 
-def update_stage(stage_name: str):
-    def update_stage_file(stage_name: str):
-        global previous_stages
-        global PROJECT_NAME
-        project_stages: dict = previous_stages.setdefault(PROJECT_NAME, {})
-        project_stages[stage_name] = True
-        with open(stage_file, "w") as f:
-            json.dump(previous_stages, f, indent=4)
+def venv_bin(venv_path, name: str) -> str:
+    """
+    Returns the absolute path to a binary inside the virtualenv, so commands
+    can address the venv directly instead of sourcing bin/activate.
+    """
+    return str(Path(venv_path).joinpath("bin", name).absolute())
 
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            project_stages: dict = previous_stages.setdefault(PROJECT_NAME, {})
-            if project_stages.get(stage_name):
-                logger.info(f"Stage {stage_name} already completed")
-                return
-            func(*args, **kwargs)
-            update_stage_file(stage_name)
 
-        return wrapper
+def venv_env(venv_path) -> dict:
+    return {**os.environ, "VIRTUAL_ENV": str(Path(venv_path).absolute())}
 
-    return decorator
+
+# skip source builds and .pyc bytecompilation; wheels come from PIP_CACHE_DIR
+PIP_INSTALL_FLAGS = ["-q", "--prefer-binary", "--no-compile", "--no-input", "--disable-pip-version-check"]
+
+
+def pip_install(venv_path: str, args: List[str]):
+    run_command(
+        [venv_bin(venv_path, "pip"), "install"] + PIP_INSTALL_FLAGS + args,
+        use_sudo=False,
+        env=venv_env(venv_path),
+    )
+
+
+try:
+    import orjson
+
+    def _dump_stages(stages: dict) -> bytes:
+        return orjson.dumps(stages)
+
+except ImportError:
+
+    def _dump_stages(stages: dict) -> bytes:
+        return json.dumps(stages, separators=(",", ":")).encode("utf-8")
+
+
+def flush_stages():
+    """
+    Atomically writes the stage file, and only when it actually changed —
+    a crash mid-write can no longer corrupt the JSON and void the cache.
+    """
+    global _stages_dirty
+    with stage_lock:
+        if not _stages_dirty:
+            return
+        tmp = stage_file.with_suffix(".json.tmp")
+        tmp.write_bytes(_dump_stages(previous_stages))
+        os.replace(tmp, stage_file)
+        _stages_dirty = False
+
+
+def _flush_stages_on_signal(signum, frame):
+    flush_stages()
+    exit(1)
+
+
+atexit.register(flush_stages)
+signal.signal(signal.SIGTERM, _flush_stages_on_signal)
+
+
+def stage_done(stage_name: str, signature: Optional[str] = None) -> bool:
+    """Returns True when the stage completed with the same input signature."""
+    project_stages: dict = previous_stages.setdefault(PROJECT_NAME, {})
+    entry = project_stages.get(stage_name)
+    done = entry.get("done") if isinstance(entry, dict) else bool(entry)
+    previous_signature = entry.get("sig") if isinstance(entry, dict) else None
+    return bool(done) and previous_signature == signature
+
+
+def mark_stage(stage_name: str, signature: Optional[str] = None):
+    global _stages_dirty
+    with stage_lock:
+        project_stages: dict = previous_stages.setdefault(PROJECT_NAME, {})
+        project_stages[stage_name] = {"done": True, "sig": signature} if signature else True
+        _stages_dirty = True
 
 
-def raise_for_deployment():
+def stage(stage_name: str, inputs_fn=None):
+    """
+    Single wrapper handling both stage bookkeeping and deployment errors.
+    Skips a stage that already completed. When `inputs_fn` is given it must
+    return a stable byte blob of the stage's inputs; the stage is then only
+    skipped while that signature is unchanged, so edited requirements or
+    templates correctly invalidate the cache.
+    """
+
     def decorator(func):
         def wrapper(*args, **kwargs):
+            signature = None
+            if inputs_fn is not None:
+                signature = hashlib.blake2b(inputs_fn(*args, **kwargs)).hexdigest()
+            if stage_done(stage_name, signature):
+                logger.info(f"Stage {stage_name} already completed")
+                return
             try:
                 func(*args, **kwargs)
             except DeploymentException as e:
                 logger.error(e)
                 exit(1)
+            mark_stage(stage_name, signature)
 
         return wrapper
 
     return decorator
 
 
-@raise_for_deployment()
-def activate_venv(venv_path):
-    global VENV_ACTIVE
-    if not VENV_ACTIVE:
-        logger.info("Activating virtualenv")
-        shell_source(f"{venv_path}/bin/activate")
-        environ = os.environ.copy()
-        if "VIRTUAL_ENV" not in environ:
-            raise DeploymentException("Failed to activate virtualenv")
-    VENV_ACTIVE = True
-    if not VENV_ACTIVE:
-        logger.info("Virtualenv activated")
-
-
 # def get_service_manager():
 #     which_service = subprocess.run(["which", "service"])
 #     which_systemctl = subprocess.run(["which", "systemctl"])
@@ -157,66 +382,76 @@ def restart_services():
     run_command([service_manager, "daemon-reload"], use_sudo=True)
     logger.info("Daemon reloaded")
 
-    # restart/start gunicorn
-    run_command([service_manager, "restart", "gunicorn"], use_sudo=True)
-    logger.info("Gunicorn restarted")
+    # one call restarts all units; the socket comes first so nginx's next
+    # connection can spin gunicorn up lazily
+    run_command(
+        [service_manager, "reload-or-restart", "gunicorn.socket", "gunicorn.service", "nginx.service"],
+        use_sudo=True,
+    )
+    logger.info("Gunicorn and Nginx restarted")
 
-    # restart/start nginx
-    run_command([service_manager, "restart", "nginx"], use_sudo=True)
-    logger.info("Nginx restarted")
 
+def configure_apt_cache(use_sudo: bool = True):
+    """
+    Points apt at a package cache under the artifacts directory so reruns
+    reuse already-downloaded .deb files instead of hitting the mirror again.
+    """
+    apt_cache_dir = artifacts_dir.joinpath("apt-cache")
+    apt_cache_dir.joinpath("partial").mkdir(parents=True, exist_ok=True)
+
+    apt_conf_src = artifacts_dir.joinpath("99keepcache")
+    apt_conf_src.write_text(
+        'Binary::apt::APT::Keep-Downloaded-Packages "true";\n' f'Dir::Cache::Archives "{apt_cache_dir.absolute()}";\n',
+        encoding="utf-8",
+    )
 
-@raise_for_deployment()
-@update_stage("update_system")
-def update_system(use_sudo: bool = True):
-    logger.info("Updating system")
-    run_command(["sudo", "apt", "update", "-y"], use_sudo=use_sudo)
-    logger.info("System updated")
+    run_command(["cp", str(apt_conf_src.absolute()), "/etc/apt/apt.conf.d/99keepcache"], use_sudo=use_sudo)
 
 
-@raise_for_deployment()
-@update_stage("install_apt_packages")
-def install_apt_packages(use_sudo: bool = True):
-    logger.info("Installing apt packages")
+@stage("prepare_system")
+def prepare_system(use_sudo: bool = True):
+    logger.info("Updating system and installing apt packages")
     package_list = [
         "python3-pip",
         "python3-dev",
         "libpq-dev",
         "nginx",
-        "curl",
         "postgresql",
         "postgresql-contrib",
         "zsh",
         "git",
         "systemd",
         "python3-venv",
+        "zstd",
     ]
-    # run apt install without any user input
-    run_command(["sudo", "apt", "install", "-y"] + package_list, use_sudo=use_sudo)
-    logger.info(f"{len(package_list)} Apt packages installed")
-
-
-@raise_for_deployment()
-@update_stage("install_python_packages")
-def install_python_packages():
-    packages = [
-        "pyperclip",
-    ]
-
-    logger.info("Installing python packages")
-    run_command(["pip3", "install"] + packages, use_sudo=False)
-
-
-@raise_for_deployment()
-@update_stage("create_project_dir")
+    configure_apt_cache(use_sudo=use_sudo)
+
+    # only refetch the index when the package list changed since the last run
+    packages_hash = hashlib.md5(",".join(sorted(package_list)).encode("utf-8")).hexdigest()
+    project_stages: dict = previous_stages.setdefault(PROJECT_NAME, {})
+    if project_stages.get("apt_packages_hash") != packages_hash:
+        run_command(["apt-get", "-o", "Dpkg::Use-Pty=0", "update", "-q", "-y"], use_sudo=use_sudo)
+
+    # run apt install without any user input, skipping recommended packages
+    run_command(
+        ["apt-get", "-o", "Dpkg::Use-Pty=0", "install", "-q", "--no-install-recommends", "-y"] + package_list,
+        use_sudo=use_sudo,
+    )
+    global _stages_dirty
+    with stage_lock:
+        project_stages["apt_packages_hash"] = packages_hash
+        _stages_dirty = True
+    logger.info(f"System updated, {len(package_list)} Apt packages installed")
+
+
+@stage("create_project_dir")
 def create_project_dir(project_dir: Path):
     logger.info("Creating project dir")
     project_dir.mkdir(parents=True, exist_ok=True)
     logger.info("Project dir created")
 
 
-@raise_for_deployment()
-@update_stage("clone_git_repo")
+@stage("clone_git_repo")
 def clone_git_repo(repo_url: str, branch: str = "master", destination_dir: Path = Path(__file__).parent):
     """
     Clones the git repo in the destination directory
@@ -230,38 +465,90 @@ def clone_git_repo(repo_url: str, branch: str = "master", destination_dir: Path
         logger.info("Git repo already cloned")
         return
     destination_dir_str = str(destination_dir.absolute())
-    run_command(["git", "clone", "-b", branch, repo_url, destination_dir_str], use_sudo=False)
+    # shallow, single-branch clone: a deploy only ever needs the branch tip
+    run_command(
+        ["git", "clone", "--depth=1", "--single-branch", "--filter=blob:none", "-b", branch, repo_url, destination_dir_str],
+        use_sudo=False,
+    )
     logger.info("Git repo cloned")
 
 
-def pull_latest_changes(project_dir: Path):
-    current_dir = os.getcwd()
-    logger.info(f"Pulling latest changes, current_dir, {current_dir}")
-    os.chdir(project_dir)
+def pull_latest_changes(project_dir: Path, branch: str = "master"):
+    logger.info("Pulling latest changes")
+    project_dir_str = str(project_dir.absolute())
     try:
-        run_command(["git", "pull"], use_sudo=False)
+        run_command(["git", "-C", project_dir_str, "fetch", "--depth=1", "origin", branch], use_sudo=False)
+        run_command(["git", "-C", project_dir_str, "reset", "--hard", "FETCH_HEAD"], use_sudo=False)
     except Exception as e:
         logger.error(e)
-    os.chdir(current_dir)
     return
 
 
-@raise_for_deployment()
-@update_stage("install_create_activate_virtualenv")
+def _venv_cache_key(project_dir: Path) -> str:
+    blob = _project_dependency_inputs("", project_dir) + sys.version.encode("utf-8")
+    return hashlib.md5(blob).hexdigest()
+
+
+def restore_venv_snapshot(project_dir: Path, venv_path: Path) -> bool:
+    """
+    Extracts a previously snapshotted venv when its cache key still matches.
+    A failed or corrupt extraction deletes the archive and any partial venv
+    and returns False, so the caller falls back to a fresh build instead of
+    hard-failing every later deploy.
+    """
+    archive = artifacts_dir.joinpath(f"venv-{_venv_cache_key(project_dir)}.tzst")
+    if venv_path.exists() or not archive.exists():
+        return False
+    logger.info(f"Restoring venv from snapshot {archive.name}")
+    try:
+        run_command(
+            ["tar", "--zstd", "-xf", str(archive.absolute()), "-C", str(venv_path.parent.absolute())],
+            use_sudo=False,
+        )
+    except DeploymentException as e:
+        logger.warning(f"Venv snapshot restore failed, rebuilding from scratch: {e}")
+        archive.unlink(missing_ok=True)
+        shutil.rmtree(venv_path, ignore_errors=True)
+        return False
+    return True
+
+
+def snapshot_venv(project_dir: Path, venv_path: Path):
+    """
+    Tars the built venv into the artifacts dir, keyed by requirements +
+    python version, so a redeploy extracts it instead of rerunning pip.
+    The archive is built under a temp name and renamed into place only on
+    tar success, so a failed snapshot can never leave a truncated .tzst.
+    """
+    archive = artifacts_dir.joinpath(f"venv-{_venv_cache_key(project_dir)}.tzst")
+    if archive.exists():
+        return
+    logger.info(f"Snapshotting venv to {archive.name}")
+    tmp_archive = archive.with_name(archive.name + ".tmp")
+    try:
+        run_command(
+            ["tar", "--zstd", "-cf", str(tmp_archive.absolute()), "-C", str(venv_path.parent.absolute()), venv_path.name],
+            use_sudo=False,
+        )
+    except DeploymentException as e:
+        # a snapshot is an optimization; losing it must not fail the deploy
+        logger.warning(f"Venv snapshot failed, skipping: {e}")
+        tmp_archive.unlink(missing_ok=True)
+        return
+    os.replace(tmp_archive, archive)
+
+
+@stage("install_create_activate_virtualenv")
 def install_create_activate_virtualenv(project_dir: Path, venv_path: Path):
     """
     Installs virtualenv and creates a virtualenv in the project directory
     Returns the path to the virtualenv
     """
-    # upgrade pip
-    logger.info("Upgrading pip")
-    run_command(["pip3", "install", "--upgrade", "pip"], use_sudo=False)
-    logger.info("Pip upgraded")
-
-    # install virtualenv
-    logger.info("Installing virtualenv")
-    run_command(["pip3", "install", "virtualenv"], use_sudo=False)
-    logger.info("Virtualenv installed")
+    if restore_venv_snapshot(project_dir, venv_path):
+        signature = hashlib.blake2b(_project_dependency_inputs(str(venv_path), project_dir)).hexdigest()
+        mark_stage("install_project_dependencies", signature)
+        logger.info("Virtualenv restored from snapshot")
+        return
 
     venv_path_str = str(venv_path.absolute())
 
@@ -272,87 +559,145 @@ def install_create_activate_virtualenv(project_dir: Path, venv_path: Path):
 
     logger.info("Virtualenv created")
 
-    # activate virtualenv
-    activate_venv(venv_path)
+    if not Path(venv_bin(venv_path, "python")).exists():
+        raise DeploymentException("Failed to create virtualenv")
+
+
+def _install_lock_in_parallel(venv_path: str, lock_file: Path) -> bool:
+    """
+    Installs a fully pinned lock file as N parallel `pip --no-deps` chunks
+    sharing one wheel cache, saturating the network instead of downloading
+    serially. Returns False when the caller should fall back to serial.
+    """
+    lines = [line for line in lock_file.read_text(encoding="utf-8").splitlines() if line.strip() and not line.startswith("#")]
+    workers = max(1, (os.cpu_count() or 2) // 2)
+    if workers < 2 or len(lines) < 2:
+        return False
+
+    chunks: List[List[str]] = [[] for _ in range(workers)]
+    for line in lines:
+        package_name = line.split("==", 1)[0].strip()
+        index = int(hashlib.md5(package_name.encode("utf-8")).hexdigest(), 16) % workers
+        chunks[index].append(line)
+
+    def install_chunk(index: int, chunk: List[str]):
+        chunk_file = artifacts_dir.joinpath(f"{PROJECT_NAME}.lock.{index}")
+        chunk_file.write_text("\n".join(chunk) + "\n", encoding="utf-8")
+        chunk_file_str = str(chunk_file.absolute())
+        pip_install(venv_path, ["--no-deps", "-r", chunk_file_str])
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(install_chunk, i, chunk) for i, chunk in enumerate(chunks) if chunk]
+            for future in futures:
+                future.result()
+    except DeploymentException as e:
+        logger.error(f"Parallel lock install failed, falling back to serial: {e}")
+        return False
+    return True
+
+
+def _project_dependency_inputs(venv_path: str, project_dir: Path) -> bytes:
+    for name in ("requirements.txt", "chill.requirements.txt"):
+        requirements_file = project_dir.joinpath(name)
+        if requirements_file.exists():
+            return requirements_file.read_bytes()
+    return b""
 
 
-@raise_for_deployment()
-@update_stage("install_project_dependencies")
+@stage("install_project_dependencies", inputs_fn=_project_dependency_inputs)
 def install_project_dependencies(venv_path: str, project_dir: Path):
-    activate_venv(venv_path)
     logger.info("Installing project dependencies")
+    # everything the venv needs goes through one resolver pass
+    base_packages = ["pip", "virtualenv", "pyperclip", "gunicorn", "psycopg2-binary"]
     requirements_file = project_dir.joinpath("requirements.txt")
     if not requirements_file.exists():
         requirements_file = project_dir.joinpath("chill.requirements.txt")
     if not requirements_file.exists():
         logger.warn("No requirements.txt file found")
+        pip_install(venv_path, ["--upgrade"] + base_packages)
+        return
+
+    # skip the install entirely when requirements.txt is unchanged since the last run
+    requirements_hash = hashlib.md5(requirements_file.read_bytes()).hexdigest()
+    project_stages: dict = previous_stages.setdefault(PROJECT_NAME, {})
+    if project_stages.get("requirements_hash") == requirements_hash:
+        logger.info("Requirements unchanged, skipping install")
         return
 
     requirements_file_str = str(requirements_file.absolute())
-    run_command(["pip3", "install", "-r", requirements_file_str], use_sudo=False)
+    lock_file = artifacts_dir.joinpath(f"{PROJECT_NAME}.lock")
+    lock_hash_file = artifacts_dir.joinpath(f"{PROJECT_NAME}.lock.md5")
+    if lock_file.exists() and lock_hash_file.exists() and lock_hash_file.read_text(encoding="utf-8").strip() == requirements_hash:
+        # replay the pinned resolve from a previous run, skipping the resolver entirely
+        logger.info("Replaying pinned requirements from lock file")
+        if not _install_lock_in_parallel(venv_path, lock_file):
+            lock_file_str = str(lock_file.absolute())
+            pip_install(venv_path, ["--no-deps", "-r", lock_file_str])
+    else:
+        pip_install(venv_path, ["--upgrade"] + base_packages + ["-r", requirements_file_str])
+        # pin the resolved set so the next fresh machine can skip the resolver
+        frozen = subprocess.check_output([venv_bin(venv_path, "pip"), "freeze"]).decode("utf-8")
+        lock_file.write_text(frozen, encoding="utf-8")
+        lock_hash_file.write_text(requirements_hash, encoding="utf-8")
+    global _stages_dirty
+    with stage_lock:
+        project_stages["requirements_hash"] = requirements_hash
+        _stages_dirty = True
     logger.info("Project dependencies installed")
 
 
-@raise_for_deployment()
-@update_stage("collect_static")
+@stage("collect_static")
 def collect_static(venv_path: str, django_project_path: Path, sub_dir: Path | None = None):
-    activate_venv(venv_path)
     logger.info("Collecting static")
     django_project_path_str = str(django_project_path.absolute()) if not sub_dir else str(django_project_path.joinpath(sub_dir).absolute())
-    run_command(["python3", f"{django_project_path_str}/manage.py", "collectstatic", "--no-input"], use_sudo=False)
+    run_command(
+        [venv_bin(venv_path, "python"), f"{django_project_path_str}/manage.py", "collectstatic", "--no-input"],
+        use_sudo=False,
+        env=venv_env(venv_path),
+    )
     logger.info("Static collected")
 
 
-@raise_for_deployment()
-@update_stage("install_gunicorn")
-def install_gunicorn(venv_path: str):
-    activate_venv(venv_path)
-    logger.info("Setting up gunicorn")
-    # install gunicorn
-    run_command(["pip3", "install", "gunicorn"], use_sudo=False)
-    logger.info("Gunicorn installed")
-
-
+@functools.lru_cache(maxsize=None)
 def get_gunicorn_path(venv_path: str):
-    activate_venv(venv_path)
-    gunicorn_path = subprocess.check_output(["which", "gunicorn"]).decode("utf-8").strip()
+    gunicorn_path = venv_bin(venv_path, "gunicorn")
+    if not Path(gunicorn_path).exists():
+        gunicorn_path = shutil.which("gunicorn")
+        if not gunicorn_path:
+            raise DeploymentException("Failed to find gunicorn")
     logger.info(f"Gunicorn path: {gunicorn_path}")
     return gunicorn_path
 
 
-@raise_for_deployment()
-@update_stage("write_gunicorn_config_files")
+def _gunicorn_config_inputs(gunicorn_path: str, django_project_path: Path, sub_dir: Path | None = None) -> bytes:
+    templates = GUNICORN_SOCKET_TMPL.template + GUNICORN_SERVICE_TMPL.template
+    return f"{templates}{gunicorn_path}{django_project_path}{sub_dir}".encode("utf-8")
+
+
+@stage("write_gunicorn_config_files", inputs_fn=_gunicorn_config_inputs)
 def write_gunicorn_config_files(gunicorn_path: str, django_project_path: Path, sub_dir: Path | None = None):
     def write_gunicorn_socket():
         try:
-            src = Path(__file__).parent.joinpath("templates/gunicorn.socket")
-            with open(src, "r") as f:
-                content = f.read()
-
-            with open(gunicorn_socket_path, "w") as f:
-                f.write(content)
+            Path(gunicorn_socket_path).write_text(GUNICORN_SOCKET_TMPL.safe_substitute(), encoding="utf-8")
         except Exception as e:
             logger.error(f"Error creating gunicorn.socket file: {e}")
             raise DeploymentException("Error creating gunicorn.socket file")
 
     def write_gunicorn_service():
         try:
-            src = Path(__file__).parent.joinpath("templates/gunicorn.service")
-            with open(src, "r") as f:
-                content = f.read()
-
-            # vars = {{USER}}, {{GROUP}}, {{APP_NAME}}, {{PROJECT_PATH}}, {{GUNICORN_PATH}}
-            current_user = getpass.getuser()
-            content = content.replace("{{USER}}", current_user)
-            content = content.replace("{{GROUP}}", "www-data")
-            content = content.replace("{{APP_NAME}}", django_project_path.name)
-            content = content.replace("{{PROJECT_PATH}}", django_project_path_str)
-            content = content.replace("{{GUNICORN_PATH}}", gunicorn_path)
+            # vars = ${USER}, ${GROUP}, ${APP_NAME}, ${PROJECT_PATH}, ${GUNICORN_PATH}
+            content = GUNICORN_SERVICE_TMPL.safe_substitute(
+                USER=_current_user(),
+                GROUP="www-data",
+                APP_NAME=django_project_path.name,
+                PROJECT_PATH=django_project_path_str,
+                GUNICORN_PATH=gunicorn_path,
+            )
 
             # TODO: add workers as a parameter
 
-            with open(gunicorn_service_path, "w") as f:
-                f.write(content)
+            Path(gunicorn_service_path).write_text(content, encoding="utf-8")
         except Exception as e:
             logger.error(f"Error creating gunicorn.service file: {e}")
             raise DeploymentException("Error creating gunicorn.service file")
@@ -365,8 +710,7 @@ def write_gunicorn_config_files(gunicorn_path: str, django_project_path: Path, s
     write_gunicorn_service()
 
 
-@raise_for_deployment()
-@update_stage("setup_nginx")
+@stage("setup_nginx")
 def setup_nginx(django_project_path: Path, domain_name: Optional[str]):
     if not domain_name:
         domain_name = get_public_ip()
@@ -376,27 +720,29 @@ def setup_nginx(django_project_path: Path, domain_name: Optional[str]):
     logger.info("Setting up nginx")
 
     # create nginx config file
-    project_name = django_project_path.name
-    django_project_path_str = str(django_project_path.absolute()) if not sub_dir else str(django_project_path.joinpath(sub_dir).absolute())
+    django_project_path_str = str(django_project_path.absolute())
     try:
-        src = Path(__file__).parent.joinpath("templates/nginx.conf")
-        with open(src, "r") as f:
-            content = f.read()
-
-        # vars = {{DOMAIN}}, {{PROJECT_PATH}}
-        content = content.replace("{{DOMAIN_NAME}}", domain_name)
-        content = content.replace("{{PROJECT_PATH}}", django_project_path_str)
+        # vars = ${DOMAIN_NAME}, ${PROJECT_PATH}
+        content = NGINX_CONF_TMPL.safe_substitute(
+            DOMAIN_NAME=domain_name,
+            PROJECT_PATH=django_project_path_str,
+        )
         nginx_root = Path(nginx_root_path)
         nginx_root.mkdir(exist_ok=True, parents=True)
         nginx_config_path = f"{nginx_root_path}/app.nginx"
-        with open(nginx_config_path, "w") as f:
-            f.write(content)
+        Path(nginx_config_path).write_text(content, encoding="utf-8")
     except Exception as e:
         logger.error(f"Error creating nginx config file: {e}")
         raise DeploymentException("Error creating nginx config file")
 
-    # enable nginx config file
-    run_command(["ln", "-s", nginx_config_path, nginx_sites_enabled_path], use_sudo=True, raise_on_error=False)
+    # enable nginx config file; a direct symlinkat beats forking sudo ln
+    try:
+        os.symlink(nginx_config_path, nginx_sites_enabled_path)
+    except FileExistsError:
+        pass
+    except OSError:
+        # sites-enabled not writable as this user: escalate once
+        run_command(["ln", "-sfn", nginx_config_path, nginx_sites_enabled_path], use_sudo=True, raise_on_error=False)
 
     # remove default nginx config file
     # run_command(["rm", f"/etc/nginx/sites-enabled/default"], use_sudo=True)
@@ -426,20 +772,48 @@ def main(
     home_dir = Path(root_path)
     load_artifacts(root_path=home_dir)
 
-    os.environ["DEBIAN_FRONTEND"] = "noninteractive"
+    if sudo and not _IS_ROOT:
+        warm_sudo_ticket()
+
+    # covers the --no-sudo/root paths where apt inherits this environment;
+    # the sudo shell exports its own copies (_SUDO_SHELL_EXPORTS)
+    os.environ.update(_SUDO_SHELL_EXPORTS)
+    # share one wheel cache across runs so reruns copy wheels instead of rebuilding
+    os.environ["PIP_CACHE_DIR"] = str(artifacts_dir.joinpath("pip-cache").absolute())
+    os.environ["PIP_DISABLE_PIP_VERSION_CHECK"] = "1"
 
-    update_system(use_sudo=sudo)
-    install_apt_packages(use_sudo=sudo)
-    install_python_packages()
-    project_dir = home_dir.joinpath(project_name).joinpath(project_name)
+    paths = DeployPaths.build(home_dir, project_name)
+    project_dir = paths.project_dir
     logger.info(f"Project dir: {project_dir}")
 
-    create_project_dir(project_dir=project_dir)
-    clone_git_repo(repo_url=git_repo, branch=git_branch, destination_dir=project_dir)
-    pull_latest_changes(project_dir=project_dir)
+    apt_done = threading.Event()
 
-    venv_path = project_dir.parent.joinpath("venv")
-    venv_path_str = str(venv_path.absolute())
+    def system_wave():
+        try:
+            prepare_system(use_sudo=sudo)
+        finally:
+            apt_done.set()
+
+    def project_wave():
+        create_project_dir(project_dir=project_dir)
+        if shutil.which("git") is None:
+            # git arrives with the apt packages; only wait when actually missing
+            apt_done.wait()
+        clone_git_repo(repo_url=git_repo, branch=git_branch, destination_dir=project_dir)
+        pull_latest_changes(project_dir=project_dir, branch=git_branch)
+
+    # apt/pip, git, and the public-IP lookup are independent of each other,
+    # so overlap their network waits
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        waves = [executor.submit(system_wave), executor.submit(project_wave)]
+        public_ip_future = executor.submit(get_public_ip) if not domain_name else None
+        for wave in waves:
+            wave.result()
+    if public_ip_future is not None:
+        domain_name = public_ip_future.result()
+
+    venv_path = paths.venv
+    venv_path_str = paths.venv_str
 
     install_create_activate_virtualenv(project_dir=project_dir, venv_path=venv_path)
     install_project_dependencies(venv_path=venv_path_str, project_dir=project_dir)
@@ -447,7 +821,7 @@ def main(
     if collectstatic:
         collect_static(venv_path=venv_path_str, django_project_path=project_dir, sub_dir=sub_dir)
 
-    install_gunicorn(venv_path=venv_path_str)
+    snapshot_venv(project_dir=project_dir, venv_path=venv_path)
     gunicorn_path = get_gunicorn_path(venv_path=venv_path_str)
     write_gunicorn_config_files(gunicorn_path=gunicorn_path, django_project_path=project_dir, sub_dir=sub_dir)
 
@@ -456,6 +830,8 @@ def main(
 
     restart_services()
 
+    flush_stages()
+
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 import logging
 import os
+import re
 from pathlib import Path
 
 
@@ -14,20 +15,14 @@ except ImportError:
     exit(1)
 
 
-def load_env_from_line(line: str):
-    line = line.strip()
-    if not line or line.startswith("#"):
-        return
-    key, value = line.split("=", 1)
-    key = key.strip()
-    value = value.strip()
-    os.environ[key] = value
+# one regex scan per file replaces the per-line strip/startswith/split dance;
+# comment lines never match because '#' is not a valid key character
+_ENV_RE = re.compile(r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t]*$", re.MULTILINE)
 
 
 def load_dotenv_from_file(env_file_path: Path):
-    with open(env_file_path, "r") as f:
-        for line in f:
-            load_env_from_line(line)
+    data = env_file_path.read_text()
+    os.environ.update({match[1]: match[2] for match in _ENV_RE.finditer(data)})
 
 
 @click.command()
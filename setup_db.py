@@ -2,17 +2,32 @@
 try:
     import click
 except ImportError:
-    print("Please install click with pip3 install click")
-    exit(1)
+    # click stays the nicer frontend (prompts, --flag/--no-flag); without it
+    # the argparse fallback below still runs the script
+    click = None
 
+import argparse
+import functools
 import logging
 import os
+import shutil
 import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Optional
 
-VENV_ACTIVE = False
+try:
+    import psycopg2
+    from psycopg2 import errors, sql
+except ImportError:
+    psycopg2 = None
 
+# absolute path of the venv activated in this process, if any
+_ACTIVE_VENV = None
+
+# already root (CI/containers): every sudo prefix is pure PAM overhead
+_IS_ROOT = os.geteuid() == 0
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,31 +41,39 @@ class InstallationException(Exception):
     pass
 
 
-def run_command(command: List[str], use_sudo: bool = True, raise_on_error: bool = True):
-    if use_sudo:
-        command = ["sudo"] + command
-    process = subprocess.run(command)
-    if process.returncode != 0 and raise_on_error:
-        raise DeploymentException(f"Failed to run command: {command}")
+@functools.lru_cache(maxsize=None)
+def _resolve_bin(name: str) -> str:
+    """Resolves a binary through PATH once so each exec is a direct lookup."""
+    return shutil.which(name) or name
 
 
-def get_public_ip() -> Optional[str]:
-    # curl https://ipv4.icanhazip.com/
+def run_command(
+    command: List[str],
+    use_sudo: bool = True,
+    raise_on_error: bool = True,
+    quiet: bool = True,
+    cwd: Optional[str] = None,
+):
+    command = [_resolve_bin(command[0])] + command[1:]
+    if use_sudo and not _IS_ROOT:
+        command = [_resolve_bin("sudo")] + command
+    # quiet drops bulk output; stderr is surfaced on failure
+    kwargs = {"stdout": subprocess.DEVNULL, "stderr": subprocess.PIPE} if quiet else {}
     try:
-        ip = subprocess.check_output(["curl", "https://ipv4.icanhazip.com/"])
-        ip = ip.decode("utf-8").strip()
-        return ip
-    except Exception as e:
-        return None
+        subprocess.run(command, check=raise_on_error, cwd=cwd, **kwargs)
+    except subprocess.CalledProcessError as e:
+        if e.stderr:
+            logger.error(e.stderr.decode(errors="replace"))
+        raise DeploymentException(f"Failed to run command: {command}") from e
 
 
-def shell_source(script):
-    """Sometime you want to emulate the action of "source" in bash,
-    settings some environment variables. Here is a way to do it."""
-    pipe = subprocess.Popen(". %s; env" % script, stdout=subprocess.PIPE, shell=True)
-    output = pipe.communicate()[0].decode("utf-8")
-    env = dict((line.split("=", 1) for line in output.splitlines()))
-    os.environ.update(env)
+def get_public_ip() -> Optional[str]:
+    # GET https://ipv4.icanhazip.com/ with a short timeout, no curl subprocess
+    try:
+        with urllib.request.urlopen("https://ipv4.icanhazip.com/", timeout=3) as response:
+            return response.read().decode("utf-8").strip()
+    except Exception:
+        return None
 
 
 def raise_for_deployment():
@@ -69,65 +92,136 @@ def raise_for_deployment():
 
 @raise_for_deployment()
 def activate_venv(venv_path):
-    global VENV_ACTIVE
-    if not VENV_ACTIVE:
-        logger.info("Activating virtualenv")
-        shell_source(f"{venv_path}/bin/activate")
-        environ = os.environ.copy()
-        if "VIRTUAL_ENV" not in environ:
-            raise DeploymentException("Failed to activate virtualenv")
-    VENV_ACTIVE = True
-    if not VENV_ACTIVE:
-        logger.info("Virtualenv activated")
+    """
+    Activates the virtualenv in-process by mutating VIRTUAL_ENV/PATH directly,
+    with no shell, no subprocess, and no env-dump parsing. Repeated calls for
+    the same venv are a no-op; a different venv in the same process is an error.
+    """
+    global _ACTIVE_VENV
+    venv_dir = Path(venv_path).absolute()
+    if _ACTIVE_VENV == str(venv_dir):
+        return
+    if _ACTIVE_VENV is not None:
+        raise DeploymentException(f"Another virtualenv is already active: {_ACTIVE_VENV}")
+    logger.info("Activating virtualenv")
+    if not venv_dir.joinpath("bin", "python").exists():
+        raise DeploymentException("Failed to activate virtualenv")
+    os.environ["VIRTUAL_ENV"] = str(venv_dir)
+    os.environ["PATH"] = f"{venv_dir}/bin{os.pathsep}" + os.environ.get("PATH", "")
+    os.environ.pop("PYTHONHOME", None)
+    _ACTIVE_VENV = str(venv_dir)
+    logger.info("Virtualenv activated")
 
 
 def restart_services():
     service_manager = "systemctl"
     # daemon_reload
     run_command([service_manager, "daemon-reload"], use_sudo=True)
-    logger.info("Daemon reloaded")
 
-    # restart/start gunicorn
-    run_command([service_manager, "restart", "gunicorn"], use_sudo=True)
-    logger.info("Gunicorn restarted")
+    # restart/start gunicorn and nginx in one systemctl call
+    run_command([service_manager, "restart", "gunicorn", "nginx"], use_sudo=True)
+    logger.info("Daemon reloaded, gunicorn and nginx restarted")
 
-    # restart/start nginx
-    run_command([service_manager, "restart", "nginx"], use_sudo=True)
-    logger.info("Nginx restarted")
+
+def _execute_tolerating_duplicates(cur, statement, params=None):
+    # reruns hit CREATE DATABASE/USER for objects that already exist; the
+    # baseline psql script tolerated those errors, so the direct path must too
+    try:
+        cur.execute(statement, params)
+    except (errors.DuplicateDatabase, errors.DuplicateObject) as e:
+        logger.info(f"Already exists, skipping: {e.diag.message_primary}")
+
+
+def _create_postgres_resources_direct(db_name, db_user, db_password, db_host, db_port):
+    """
+    Executes the DDL over a direct psycopg2 connection — no SQL file on disk,
+    no chmod/chown, no `sudo su postgres` shell. Identifiers are quoted with
+    psycopg2.sql so db/user names cannot inject SQL. Raises OperationalError
+    when a connection cannot be made at all (e.g. peer-auth-only setups where
+    TCP as `postgres` is refused); the caller falls back to psql for that.
+    """
+    conn = psycopg2.connect(dbname="postgres", user="postgres", host=db_host or "localhost", port=db_port or 5432)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            _execute_tolerating_duplicates(cur, sql.SQL("CREATE DATABASE {}").format(sql.Identifier(db_name)))
+            _execute_tolerating_duplicates(
+                cur, sql.SQL("CREATE USER {} WITH PASSWORD %s").format(sql.Identifier(db_user)), (db_password,)
+            )
+            cur.execute(sql.SQL("ALTER ROLE {} SET client_encoding TO 'utf8'").format(sql.Identifier(db_user)))
+            cur.execute(
+                sql.SQL("ALTER ROLE {} SET default_transaction_isolation TO 'read committed'").format(
+                    sql.Identifier(db_user)
+                )
+            )
+            cur.execute(sql.SQL("ALTER ROLE {} SET timezone TO 'Asia/Kolkata'").format(sql.Identifier(db_user)))
+            cur.execute(
+                sql.SQL("GRANT ALL PRIVILEGES ON DATABASE {} TO {}").format(
+                    sql.Identifier(db_name), sql.Identifier(db_user)
+                )
+            )
+            cur.execute(sql.SQL("ALTER ROLE {} SUPERUSER").format(sql.Identifier(db_user)))
+    finally:
+        conn.close()
 
 
 @raise_for_deployment()
 def create_postgres_resources(
-    artifacts_dir: Path, db_name, db_user, db_password, db_host, db_port, execute_sql: bool = True
+    artifacts_dir: Path,
+    db_name,
+    db_user,
+    db_password,
+    db_host,
+    db_port,
+    execute_sql: bool = True,
+    emit_sql: bool = False,
 ):
-    line = ""
-    line += f"CREATE DATABASE {db_name};\n"
-    line += f"CREATE USER {db_user} WITH PASSWORD '{db_password}';\n"
-    line += f"ALTER ROLE {db_user} SET client_encoding TO 'utf8';\n"
-    line += f"ALTER ROLE {db_user} SET default_transaction_isolation TO 'read committed';\n"
-    line += f"ALTER ROLE {db_user} SET timezone TO 'Asia/Kolkata';\n"
-    line += f"GRANT ALL PRIVILEGES ON DATABASE {db_name} TO {db_user};\n"
-    line += f"ALTER ROLE {db_user} SUPERUSER;"
-
-    if execute_sql:
+    if db_password and "'" in db_password:
+        # the psql fallback interpolates the password into a quoted literal
+        raise DeploymentException("DB_PASSWORD must not contain single quotes")
+    line = "\n".join(
+        [
+            f"CREATE DATABASE {db_name};",
+            f"CREATE USER {db_user} WITH PASSWORD '{db_password}';",
+            f"ALTER ROLE {db_user} SET client_encoding TO 'utf8';",
+            f"ALTER ROLE {db_user} SET default_transaction_isolation TO 'read committed';",
+            f"ALTER ROLE {db_user} SET timezone TO 'Asia/Kolkata';",
+            f"GRANT ALL PRIVILEGES ON DATABASE {db_name} TO {db_user};",
+            f"ALTER ROLE {db_user} SUPERUSER;",
+        ]
+    )
+
+    if emit_sql:
+        # debug artifact only; the execution paths below never read it.
+        # one O_TRUNC open with 0o600 — the file holds the DB password
         sql_script_path = artifacts_dir.joinpath("create_db.sql")
-        if sql_script_path.exists():
-            sql_script_path.unlink()
-        with open(sql_script_path, "w") as f:
+        fd = os.open(sql_script_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
             f.write(line)
+        logger.info(f"SQL Script Path: {str(sql_script_path)}")
 
-        sql_script_path.chmod(0o777)
-        # chown
-        run_command(["chown", "postgres:postgres", str(sql_script_path.absolute())], use_sudo=True)
-        sql_script_path_str = str(sql_script_path.absolute())
+    if execute_sql:
+        logger.info("Creating postgres resources")
+        if psycopg2 is not None:
+            try:
+                _create_postgres_resources_direct(db_name, db_user, db_password, db_host, db_port)
+                logger.info("Postgres resources created")
+                return
+            except psycopg2.OperationalError as e:
+                # TCP connection refused or password auth failed: peer auth
+                # over the socket via `sudo -u postgres psql` still works
+                logger.warning(f"Direct postgres connection failed, falling back to psql: {e}")
+            except psycopg2.Error as e:
+                raise DeploymentException("Failed to create postgres resources") from e
+
+        # psycopg2 unavailable or unable to connect: pipe the SQL into psql
         print("-" * 50)
         print(line)
         print("-" * 50)
-
-        logger.info(f"SQL Script Path: {sql_script_path_str}")
-
-        logger.info("Creating postgres resources")
-        run_command(["sudo", "su", "postgres", "-c", f"psql -f {sql_script_path_str}"], use_sudo=False)
+        try:
+            subprocess.run(["sudo", "-u", "postgres", "psql"], input=line.encode("utf-8"), check=True)
+        except subprocess.CalledProcessError as e:
+            raise DeploymentException("Failed to create postgres resources") from e
         logger.info("Postgres resources created")
     else:
         logger.info("SQL Execution disabled")
@@ -138,55 +232,54 @@ def create_postgres_resources(
 
 
 def pull_latest_changes(project_dir: Path):
-    current_dir = os.getcwd()
     logger.info("Pulling latest changes")
-    os.chdir(project_dir)
-    run_command(["git", "pull"], use_sudo=False)
-    os.chdir(current_dir)
+    # cwd= scopes the directory change to the child; the parent CWD never moves
+    run_command(["git", "pull"], use_sudo=False, cwd=str(project_dir))
     return
 
 
 def migrate_db(django_project_path: Path):
     logger.info("Migrating database")
-    django_project_path_str = str(django_project_path.absolute())
+    django_project_path_str = str(django_project_path)
     run_command(["python", f"{django_project_path_str}/manage.py", "migrate"], use_sudo=False)
     logger.info("Database migrated")
 
 
-def load_env_from_line(line: str):
-    line = line.strip()
-    if not line or line.startswith("#"):
-        return
-    key, value = line.split("=", 1)
-    key = key.strip()
-    value = value.strip()
-    os.environ[key] = value
-
-
-def load_dotenv_from_file(env_file_path: Path):
-    with open(env_file_path, "r") as f:
-        for line in f:
-            load_env_from_line(line)
+def load_dotenv_from_file(env_file_path: Path) -> dict:
+    # parse once into a dict; callers index it directly instead of bouncing
+    # every lookup through os.environ
+    env = {}
+    for line in env_file_path.read_text().splitlines():
+        stripped = line.strip()
+        if not stripped or stripped[0] == "#":
+            continue
+        key, _, value = stripped.partition("=")
+        env[key.strip()] = value.strip()
+    # still exported so child processes (manage.py migrate) see the DB settings
+    os.environ.update(env)
+    return env
 
 
-@click.command()
-@click.option("--root-path", prompt="Root Path", help="Path to store project files")
-@click.option("--project-name", prompt="Project name", help="Project name")
-@click.option("--env-file", default=".env", help="Path to .env file")
-@click.option("--execute-sql/--no-execute-sql", prompt="Execute SQL", help="Execute SQL", default=True)
-@click.option("--migrate/--no-migrate", prompt="Migrate", help="Migrate", default=True)
-def main(
+def run(
     root_path: str,
     project_name: str,
-    env_file: str,
-    execute_sql: bool,
-    migrate: bool,
+    env_file: str = ".env",
+    execute_sql: bool = True,
+    migrate: bool = True,
+    emit_sql: bool = False,
 ):
     global PROJECT_NAME
     PROJECT_NAME = project_name
+
+    if not _IS_ROOT:
+        # validate sudo once so later systemctl/psql calls skip the PAM stack
+        subprocess.run(["sudo", "-v"], check=False)
+
+    # resolve() does the cwd prepend once; downstream helpers can str() the
+    # paths without re-running Path.absolute() (a getcwd each call)
     home_dir = Path(root_path)
-    project_dir = home_dir.joinpath(project_name).joinpath(project_name)
-    artifacts_dir = home_dir.joinpath(".deployment_artifacts")
+    project_dir = home_dir.joinpath(project_name, project_name).resolve()
+    artifacts_dir = home_dir.joinpath(".deployment_artifacts").resolve()
 
     env_file_path = Path(env_file)
     if not env_file_path.exists():
@@ -194,17 +287,29 @@ def main(
         return
 
     try:
-        load_dotenv_from_file(env_file_path)
-        db_name = os.environ.get("DB_NAME")
-        db_user = os.environ.get("DB_USER")
-        db_password = os.environ.get("DB_PASSWORD")
-        db_host = os.environ.get("DB_HOST")
-        db_port = os.environ.get("DB_PORT")
-
-        create_postgres_resources(artifacts_dir, db_name, db_user, db_password, db_host, db_port, execute_sql)
+        env = load_dotenv_from_file(env_file_path)
+        try:
+            db_name, db_user, db_password, db_host, db_port = (
+                env[key] for key in ("DB_NAME", "DB_USER", "DB_PASSWORD", "DB_HOST", "DB_PORT")
+            )
+        except KeyError as e:
+            raise DeploymentException(f"Missing env var in {env_file}: {e}")
+
+        if migrate and "VIRTUAL_ENV" not in os.environ:
+            raise DeploymentException("Virtualenv not activated, please activate it first")
+
+        # postgres bootstrap and git pull are independent, so overlap their waits;
+        # migrate needs both and runs after the join
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            db_future = executor.submit(
+                create_postgres_resources, artifacts_dir, db_name, db_user, db_password, db_host, db_port, execute_sql, emit_sql
+            )
+            pull_future = executor.submit(pull_latest_changes, project_dir) if migrate else None
+            db_future.result()
+            if pull_future is not None:
+                pull_future.result()
+
         if migrate:
-            if "VIRTUAL_ENV" not in os.environ:
-                raise DeploymentException("Virtualenv not activated, please activate it first")
             migrate_db(project_dir)
 
         restart_services()
@@ -215,5 +320,36 @@ def main(
         raise e
 
 
+if click is not None:
+
+    @click.command()
+    @click.option("--root-path", prompt="Root Path", help="Path to store project files")
+    @click.option("--project-name", prompt="Project name", help="Project name")
+    @click.option("--env-file", default=".env", help="Path to .env file")
+    @click.option("--execute-sql/--no-execute-sql", prompt="Execute SQL", help="Execute SQL", default=True)
+    @click.option("--migrate/--no-migrate", prompt="Migrate", help="Migrate", default=True)
+    @click.option("--emit-sql/--no-emit-sql", help="Write the generated SQL to the artifacts dir", default=False)
+    def main(**kwargs):
+        run(**kwargs)
+
+else:
+
+    def main():
+        parser = argparse.ArgumentParser(description="Setup the project database and restart services")
+        parser.add_argument("--root-path", required=True, help="Path to store project files")
+        parser.add_argument("--project-name", required=True, help="Project name")
+        parser.add_argument("--env-file", default=".env", help="Path to .env file")
+        parser.add_argument("--execute-sql", action=argparse.BooleanOptionalAction, default=True, help="Execute SQL")
+        parser.add_argument("--migrate", action=argparse.BooleanOptionalAction, default=True, help="Migrate")
+        parser.add_argument(
+            "--emit-sql",
+            action=argparse.BooleanOptionalAction,
+            default=False,
+            help="Write the generated SQL to the artifacts dir",
+        )
+        args = parser.parse_args()
+        run(**vars(args))
+
+
 if __name__ == "__main__":
     main()